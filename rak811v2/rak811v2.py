@@ -22,23 +22,30 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
-from binascii import hexlify
+from binascii import Error as BinasciiError, a2b_hex, b2a_hex
 from enum import IntEnum
 from time import sleep
 
-from RPi import GPIO
-
 from .exception import Rak811v2Error
 from .serial import Rak811v2Serial, Rak811v2TimeoutError
 
 RESET_BCM_PORT = 17
 RESET_DELAY = 0.01
 RESET_POST = 2
+# Multi-line information output is considered complete when no line has been
+# received for that long
+INFO_QUIET_TIME = 0.2
 RESPONSE_OK = 'OK'
 RESPONSE_ERROR = 'ERROR:'
 RESPONSE_EVENT = 'at+recv='
 RESPONSE_OK_INIT = 'Initialization OK'
 
+# Pre-encoded commands without parameters
+_CMD_VERSION = b'at+version\r\n'
+_CMD_RUN = b'at+run\r\n'
+_CMD_JOIN = b'at+join\r\n'
+_CMD_HELP = b'at+help\r\n'
+
 
 # RAK811 error codes and associated messages
 
@@ -110,7 +117,53 @@ RESPONSE_MESSAGE = {
     ResponseCode.ErrMnyDwnLinkFrameLost: 'Too many downlink frames lost',
     ResponseCode.ErrAddrFail: 'Address fail',
     ResponseCode.ErrVerifyMIC: 'Error verifying MIC',
-}   
+}
+
+# RAK811 event codes and associated messages
+
+class EventCode(IntEnum):
+    """Event codes."""
+    RECV_DATA = 0
+    TX_COMFIRMED = 1
+    TX_UNCOMFIRMED = 2
+    JOINED_SUCCESS = 3
+    JOINED_FAILED = 4
+    TX_TIMEOUT = 5
+    RX2_TIMEOUT = 6
+    DOWNLINK_REPEATED = 7
+    WAKE_UP = 8
+    P2PTX_COMPLETE = 9
+    UNKNOWN = 100
+
+EVENT_MESSAGE = {
+    EventCode.RECV_DATA: 'Received data',
+    EventCode.TX_COMFIRMED: 'Tx confirmed',
+    EventCode.TX_UNCOMFIRMED: 'Tx unconfirmed',
+    EventCode.JOINED_SUCCESS: 'Join succeeded',
+    EventCode.JOINED_FAILED: 'Join failed',
+    EventCode.TX_TIMEOUT: 'Tx timeout',
+    EventCode.RX2_TIMEOUT: 'Rx2 timeout',
+    EventCode.DOWNLINK_REPEATED: 'Downlink repeated',
+    EventCode.WAKE_UP: 'Wake up',
+    EventCode.P2PTX_COMPLETE: 'P2P Tx complete',
+    EventCode.UNKNOWN: 'Unknown',
+}
+
+# Lookup tables for the exceptions. Response codes are small positive ints,
+# their messages are indexed by code (None for unassigned codes); events use
+# a plain int keyed copy of the message table.
+_RESPONSE_MSG = tuple(RESPONSE_MESSAGE.get(code)
+                      for code in range(max(RESPONSE_MESSAGE) + 1))
+_UNKNOWN_RESPONSE_MSG = RESPONSE_MESSAGE[ResponseCode.Unknown]
+_EVENT_MSG = {int(k): v for k, v in EVENT_MESSAGE.items()}
+_UNKNOWN_EVENT_MSG = _EVENT_MSG[EventCode.UNKNOWN]
+
+# Events which are not errors
+_OK_STATUSES = frozenset((
+    EventCode.RECV_DATA,
+    EventCode.TX_COMFIRMED,
+    EventCode.TX_UNCOMFIRMED,
+))
 
 
 class Rak811v2ResponseError(Rak811v2Error):
@@ -129,10 +182,11 @@ class Rak811v2ResponseError(Rak811v2Error):
         except ValueError:
             self.errno = code
 
-        if self.errno in RESPONSE_MESSAGE:
-            self.strerror = RESPONSE_MESSAGE[self.errno]
-        else:
-            self.strerror = RESPONSE_MESSAGE[ResponseCode.Unknown]
+        errno = self.errno
+        msg = None
+        if isinstance(errno, int) and 0 <= errno < len(_RESPONSE_MSG):
+            msg = _RESPONSE_MSG[errno]
+        self.strerror = msg or _UNKNOWN_RESPONSE_MSG
         super().__init__(('[Errno {}] {}').format(self.errno, self.strerror))
 
 
@@ -145,17 +199,16 @@ class Rak811v2EventError(Rak811v2Error):
 
     """
 
-    def __init__(self, status):
-        """Just assign return status."""
+    def __init__(self, status, strerror=None):
+        """Just assign return status, and message if not the default one."""
         try:
             self.errno = int(status)
         except ValueError:
             self.errno = status
 
-        if self.errno in EVENT_MESSAGE:
-            self.strerror = EVENT_MESSAGE[self.errno]
-        else:
-            self.strerror = EVENT_MESSAGE[EventCode.UNKNOWN]
+        if strerror is None:
+            strerror = _EVENT_MSG.get(self.errno, _UNKNOWN_EVENT_MSG)
+        self.strerror = strerror
         super().__init__(('[Errno {}] {}').format(self.errno, self.strerror))
 
 
@@ -169,6 +222,7 @@ class Rak811v2(object):
         All parameters are optional and passed to RackSerial.
         """
         self._serial = Rak811v2Serial(**kwargs)
+        self._downlink = []
 
 
     def close(self):
@@ -185,7 +239,14 @@ class Rak811v2(object):
         issued once after host boot, or module restart.
         Note that we do not cleanup() as the reset port should stay high (it is
         configured that way at boot time).
+        RPi.GPIO is only imported here, so that the rest of the class can be
+        used on hosts where it is not available.
         """
+        try:
+            from RPi import GPIO
+        except ImportError:
+            raise Rak811v2Error('RPi.GPIO is required for hard reset')
+
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(RESET_BCM_PORT, GPIO.OUT)
@@ -194,13 +255,27 @@ class Rak811v2(object):
         GPIO.output(RESET_BCM_PORT, GPIO.HIGH)
         sleep(RESET_POST)
 
-    def _int(self, i):
-        """Attempt int conversion."""
+    @staticmethod
+    def _int(i):
+        """Attempt int conversion, return i unchanged if not numeric.
+
+        Strings are checked before conversion, so that the common non numeric
+        fields do not go through an exception.
+        """
+        if (isinstance(i, str) and '_' not in i
+                and not i.strip().lstrip('+-').isdecimal()):
+            return i
         try:
-            i = int(i)
+            return int(i)
         except ValueError:
-            pass
-        return i
+            return i
+
+    @staticmethod
+    def _encode_payload(data):
+        """Hex encode payload, strings are UTF-8 encoded first."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return b2a_hex(data)
+        return b2a_hex(data.encode('utf-8'))
 
     def _send_string(self, string):
         """Send string to the RAK811 module."""
@@ -215,6 +290,19 @@ class Rak811v2(object):
         Rack811TimeoutError will be raised.
         """
         self._serial.send_command(command)
+        return self._check_response(timeout)
+
+    def _send_frame(self, frame, timeout=None):
+        """Send an encoded AT command frame and return the response.
+
+        Same as _send_command, for callers building the full command line
+        (including 'at+' and EOL) as bytes.
+        """
+        self._serial.send_frame(frame)
+        return self._check_response(timeout)
+
+    def _check_response(self, timeout=None):
+        """Wait for the command response and check it."""
         #response = self._serial.get_response()
         response =""
         try:
@@ -246,35 +334,27 @@ class Rak811v2(object):
 
         This is a "blocking" call: it will either return a list of informational message or
         raise a Rack811TimeoutError.
+        It waits for the first message, then collects the following ones
+        until none is received for INFO_QUIET_TIME seconds.
         """
-        self.x = []
-        while True:
-            try:
-                self.x.append(self._serial.get_info(timeout))
-            except Rak811v2TimeoutError:
-                if len(self.x) != 0:
-                    break
-                raise
+        out = [self._serial.get_info(timeout)]
+        out.extend(self._serial.drain_info(INFO_QUIET_TIME))
 
-        return self.x
+        return out
 
     def get_events(self, timeout=10):
         """Get events from the RAK811 module.
 
         This is a "blocking" call: it will either return a list of events or
         raise a Rack811TimeoutError.
+        It waits for the first event only, and returns it together with the
+        events already received at that time.
         """
 
-        self.events = []
-        while True:
-            try:
-                self.events.append(self._serial.get_event(timeout))
-            except Rak811v2TimeoutError:
-                if len(self.events) != 0:
-                    break
-                raise
+        out = [self._serial.get_event(timeout)]
+        out.extend(self._serial.drain_events())
 
-        return self.events
+        return out
     
         # return [i[len(RESPONSE_EVENT):] for i in
         #         self._serial.get_events(timeout)]
@@ -284,20 +364,20 @@ class Rak811v2(object):
     @property
     def version(self):
         """Get module version."""
-        return(self._send_command('version'), self.get_info())
+        return(self._send_frame(_CMD_VERSION), self.get_info())
         #return(self._send_command('version'))
 
     def run(self):
         """Issue Run command"""
-        return(self._send_command('run'))
+        return(self._send_frame(_CMD_RUN))
 
     def join(self):
         """Issue Join command"""
-        return(self._send_command('join', timeout=30))
+        return(self._send_frame(_CMD_JOIN, timeout=30))
 
     def help(self):
         """Issue Help command"""
-        return(self._send_command('help'))
+        return(self._send_frame(_CMD_HELP))
     
     def set_config(self, parameter):
         """Set configuration parameters by sending the AT command
@@ -379,7 +459,7 @@ class Rak811v2(object):
 
         """
 
-        cmd = 'set_config={0}'.format(parameter)
+        cmd = b'set_config=%b' % str(parameter).encode('utf-8')
         return (self._send_command(cmd))
 
     def get_config(self, parameter):
@@ -399,11 +479,57 @@ class Rak811v2(object):
         Note: get_config returns always strings, no integer do avoid unwanted
         conversion for keys.
         """
-        cmd = 'get_config={0}'.format(parameter)
+        cmd = b'get_config=%b' % str(parameter).encode('utf-8')
         return (self._send_command(cmd))
 
 
     
+    def _add_downlink(self, event_items):
+        """Add downlink message to the downlink queue.
+
+        Format: <port>[,<rssi>][,<snr>],<len>[,<data>]
+        The data may also be separated from the length by a ':'.
+        Rak811v2EventError is raised if the message cannot be parsed.
+        """
+        items = ','.join(event_items).replace(':', ',').split(',')
+        try:
+            port = self._int(items.pop(0))
+            if len(items) > 2:
+                rssi = self._int(items.pop(0))
+                snr = self._int(items.pop(0))
+            else:
+                rssi = 0
+                snr = 0
+            length = self._int(items.pop(0))
+            if length and items:
+                data = a2b_hex(items.pop(0))
+            else:
+                data = b''
+        except (BinasciiError, IndexError):
+            raise Rak811v2EventError(EventCode.RECV_DATA,
+                                     'Malformed downlink message')
+        self._downlink.append({
+            'port': port,
+            'rssi': rssi,
+            'snr': snr,
+            'len': length,
+            'data': data,
+        })
+
+    @property
+    def nb_downlinks(self):
+        """Get number of downlink messages in the queue."""
+        return len(self._downlink)
+
+    def get_downlink(self):
+        """Get oldest downlink message, or None if there is none.
+
+        Messages are dicts with keys port, rssi, snr, len and data (bytes).
+        """
+        if not self._downlink:
+            return None
+        return self._downlink.pop(0)
+
     def _process_events(self, timeout=None):
         """Process module event queue.
 
@@ -415,22 +541,25 @@ class Rak811v2(object):
 
         """
         events = self.get_events(timeout)
-        # Check for downlink
+        # Check for downlink and errors in a single pass, errors are raised
+        # once all downlinks have been recorded
+        error = None
         for event in events:
             # Format: <status >,<port>[,<rssi>][,<snr>],<len>[,<data>]
+            if event.startswith(RESPONSE_EVENT):
+                event = event[len(RESPONSE_EVENT):]
             event_items = event.split(',')
-            status = event_items.pop(0)
-            status = self._int(status)
+            status = self._int(event_items[0])
             if status == EventCode.RECV_DATA:
-                self._add_downlink(event_items)
-        # Check for errors
-        for event in events:
-            status = event.split(',')[0]
-            status = self._int(status)
-            if status not in (EventCode.RECV_DATA,
-                              EventCode.TX_COMFIRMED,
-                              EventCode.TX_UNCOMFIRMED):
-                raise Rak811v2EventError(status)
+                try:
+                    self._add_downlink(event_items[1:])
+                except Rak811v2EventError as e:
+                    if error is None:
+                        error = e
+            elif status not in _OK_STATUSES and error is None:
+                error = Rak811v2EventError(status)
+        if error is not None:
+            raise error
 
 
     def send_lora(self, data, port=1):
@@ -439,41 +568,47 @@ class Rak811v2(object):
 
         Parameters:
             <data>: data to be sent. 
-            If the datatype is bytes it will be sent as such. Strings will be converted to bytes.
+            If the datatype is bytes-like it will be sent as such. Strings will be converted to bytes.
             <port>: port number to use (1-223). If omitted default is 1
 
         """
 
-        if type(data) is not bytes:
-            data = (bytes)(data, 'utf-8')
-        data = hexlify(data).decode('ascii')
-
-        resp = self._send_command('send=lora:' + ':'.join((
-            str(port),
-            data
-        )))
+        resp = self._send_frame(b'at+send=lora:%d:%b\r\n' % (
+            int(port), self._encode_payload(data)
+        ))
 
         return resp
 
+    def make_lora_sender(self, port=1):
+        """Return a function sending data through LoRa on a fixed port.
+
+        The returned function takes the same data parameter as send_lora, and
+        an optional response timeout. The command prefix for the port is
+        built once, which saves some work when sending often on the same port.
+        """
+        prefix = b'at+send=lora:%d:' % int(port)
+
+        def send(data, timeout=None):
+            return self._send_frame(
+                prefix + self._encode_payload(data) + b'\r\n', timeout
+            )
+
+        return send
+
     def send_uart(self, data, index=1):
         """This Command is used to send data through a UART using
             at+send=uart:<index>:<data>
 
         Parameters:
             <data>: data to be sent. 
-            If the datatype is bytes it will be sent as such. Strings will be converted to bytes.
+            If the datatype is bytes-like it will be sent as such. Strings will be converted to bytes.
             <index>: UART index to use (1 or 3). If omitted default is 1
 
         """
 
-        if type(data) is not bytes:
-            data = (bytes)(data, 'utf-8')
-        data = hexlify(data).decode('ascii')
-
-        resp = self._send_command('send=uart:' + ':'.join((
-            str(index),
-            data
-        )))
+        resp = self._send_frame(b'at+send=uart:%d:%b\r\n' % (
+            int(index), self._encode_payload(data)
+        ))
 
         return resp
 
@@ -483,13 +618,11 @@ class Rak811v2(object):
 
         Parameters:
             <data>: data to be sent.
-            If the datatype is bytes it will be sent as such. Strings will be converted to bytes.
+            If the datatype is bytes-like it will be sent as such. Strings will be converted to bytes.
         """
 
-        if type(data) is not bytes:
-            data = (bytes)(data, 'utf-8')
-        data = hexlify(data).decode('ascii')
-
-        resp = self._send_command('send=lorap2p:' + data)
+        resp = self._send_frame(
+            b'at+send=lorap2p:%b\r\n' % self._encode_payload(data)
+        )
 
         return resp
@@ -20,27 +20,29 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
-from re import match
-from threading import Condition, Event, Thread
-from time import sleep
-from queue import SimpleQueue
-from _queue import Empty
+from collections import deque
+from functools import partial
+from select import select
+from threading import Condition
+from time import monotonic
 import logging
 
-import ctypes
-
 from rak811v2.exception import Rak811v2Error
-from serial import Serial
+from serial import Serial, SerialTimeoutException
+from serial.threaded import Packetizer, ReaderThread
+
+_logger = logging.getLogger(__name__)
 
 # Default instance parameters. Can be overridden  at creation
 # Serial port configuration
 PORT = '/dev/serial0'
 BAUDRATE = 115200
-# Timeout for the reader thread. Any value will do, the only impact is the time
-# needed to stop the thread when the instance is destroyed...
+# Timeout for serial reads. Any value will do: the reader thread cancels
+# pending reads when the instance is destroyed...
 TIMEOUT = 2
 # Timeout for response and events
 # The RAK811 typically respond in less than 1.5 seconds
+# The response timeout is also used as serial write timeout
 RESPONSE_TIMEOUT = 5
 # Event wait time strongly depends on duty cycle, when sending often at high SF
 # the module will wait to respect the duty cycle.
@@ -55,6 +57,19 @@ RESPONSE_OK_INIT ='Initialization OK'
 RESPONSE_ERROR = 'ERROR'
 RESPONSE_EVENT = 'at+recv='
 
+# Line routing: tags given to a line, by prefix of the raw line.
+# Lines not matching any prefix are information only.
+_RESPONSE_TAG = 0
+_INFO_TAG = 1
+_EVENT_TAG = 2
+_NB_TAGS = 3
+_PREFIX_TABLE = sorted((
+    (RESPONSE_OK.encode('ascii'), (_RESPONSE_TAG, _INFO_TAG)),
+    (RESPONSE_ERROR.encode('ascii'), (_RESPONSE_TAG,)),
+    (RESPONSE_EVENT.encode('ascii'), (_EVENT_TAG,)),
+    (RESPONSE_OK_INIT.encode('ascii'), (_RESPONSE_TAG, _INFO_TAG)),
+), key=lambda entry: len(entry[0]), reverse=True)
+_DEFAULT_ROUTE = (_INFO_TAG,)
 
 
 class Rak811v2TimeoutError(Rak811v2Error):
@@ -63,6 +78,43 @@ class Rak811v2TimeoutError(Rak811v2Error):
     pass
 
 
+class _LineProtocol(Packetizer):
+    """Split the serial stream in lines and hand them over for routing."""
+
+    TERMINATOR = EOL.encode('ascii')
+
+    def __init__(self, handler):
+        """Initialise protocol with the line handler."""
+        super().__init__()
+        self._handler = handler
+
+    def data_received(self, data):
+        """Buffer received data and process complete lines.
+
+        The buffer is reused: complete lines are sliced out of it and it is
+        compacted once per chunk of data rather than split for every line.
+        """
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        try:
+            while True:
+                end = buffer.find(self.TERMINATOR, start)
+                if end < 0:
+                    break
+                line = bytes(buffer[start:end])
+                start = end + len(self.TERMINATOR)
+                self.handle_packet(line)
+        finally:
+            # Lines handed over are consumed, even if handling one failed
+            if start:
+                del buffer[:start]
+
+    def handle_packet(self, packet):
+        """Process a complete line (without terminator)."""
+        self._handler(packet)
+
+
 class Rak811v2Serial(object):
     """Handles serial communication between the RPi and the RAK811 module."""
 
@@ -72,15 +124,20 @@ class Rak811v2Serial(object):
                  timeout=TIMEOUT,
                  response_timeout=RESPONSE_TIMEOUT,
                  event_timeout=EVENT_TIMEOUT,
+                 threaded=True,
                  **kwargs):
         """Initialise class.
 
         The serial port is immediately opened and flushed.
         All parameters are optional and passed to Serial.
+
+        When threaded is False no read thread is started: the serial port is
+        read from the caller's thread while waiting in get_response, get_info
+        and get_event, or explicitly with pump().
         """
-        self._logger = logging.getLogger(__name__)
         self._read_buffer_timeout = response_timeout
 #        self._event_timeout = event_timeout
+        kwargs.setdefault('write_timeout', response_timeout)
         self._serial = Serial(port=port,
                               baudrate=baudrate,
                               timeout=timeout,
@@ -90,69 +147,132 @@ class Rak811v2Serial(object):
         self._response_timeout = response_timeout
         self._event_timeout = event_timeout
 
-        ##Create Q to hold data read
-        self.Info_q = SimpleQueue()
-        self.RecvEvents_q = SimpleQueue()
-        self.Resp_q = SimpleQueue()
+        ##Create buffer to hold data read
+        # Lines are kept in arrival order, tagged with their category:
+        # _RESPONSE_TAG for OK and Error responses, _EVENT_TAG for all
+        # 'at+recv' event responses and _INFO_TAG for all other responses.
+        # The condition guards the buffer and the per tag line counts.
+        self._cv = Condition()
+        self._buf = deque()
+        self._counts = [0] * _NB_TAGS
         # Read thread
-        self._read_done = Event()
-        ##self._resp_ready = Event()
-
-        self._read_thread = Thread(target=self._read_loop, daemon=True)
-        self._read_thread.start()
+        if threaded:
+            self._line_protocol = None
+            self._read_thread = ReaderThread(
+                self._serial,
+                partial(_LineProtocol, self._route_line)
+            )
+            self._read_thread.start()
+        else:
+            self._line_protocol = _LineProtocol(self._route_line)
+            self._read_thread = None
 
     def close(self):
         """Release resources."""
-        self._read_done.set()
-        self._read_thread.join()
+        if self._read_thread is not None:
+            self._read_thread.stop()
         self._serial.close()
 
-    def _clear_q(self, q):
-        while not q.empty():
-            try:
-                q.get(False)
-            except Empty:
-                continue
-
     def _clear_all_qs(self):
-        self._clear_q(self.Info_q)
-        self._clear_q(self.RecvEvents_q)
-        self._clear_q(self.Resp_q)
-
-    def _read_loop(self):
-        """Read thread.
-
-        Continuously read serial. When data is available we want to read all of
-        it and notify once:
-            - We need to drain the input after a response. If we notify()
-            too early the module will miss next command
-            - We want to catch all events at the same time
-
-        Modified from the original to use 3 queues.
-        Resp_q - response q will be used for OK and Error responses 
-        RecvEvents_q - Events q will be used for all 'at+recv' event responses
-        Info_q - Informatioin q will be used for all other responses.
+        """Discard all pending lines."""
+        with self._cv:
+            self._buf.clear()
+            self._counts[:] = [0] * _NB_TAGS
+
+    def _route_line(self, raw):
+        """Route a line received by the read thread.
+
+        The read thread reads whatever is available on the serial port in one
+        go and calls us for each complete line.
+
+        Modified from the original to tag lines as response, event or
+        information; OK responses are tagged both as response and
+        information.
+        """
+        if not raw:
+            return
+        _logger.debug('Recvd: %s', raw)
+        for prefix, route in _PREFIX_TABLE:
+            if raw.startswith(prefix):
+                break
+        else:
+            route = _DEFAULT_ROUTE
+        line = raw.decode('ascii').rstrip(EOL)
+        with self._cv:
+            for tag in route:
+                self._buf.append((tag, line))
+                self._counts[tag] += 1
+            self._cv.notify_all()
+
+    def pump(self, timeout=0):
+        """Read and route data from module, single threaded mode only.
+
+        Wait at most timeout seconds for data to be available, then process
+        everything received so far.
         """
-        while not self._read_done.is_set():
-            line = self._serial.readline()
-            if line == b'':
-                continue
-            self._logger.debug('Recvd: %s', line)
-            line = line.decode('ascii').rstrip(EOL)
-            if line.startswith(RESPONSE_OK):
-                self.Resp_q.put(line)
-                self.Info_q.put(line)
-            elif line.startswith(RESPONSE_ERROR):
-                self.Resp_q.put(line)
-            elif line.startswith(RESPONSE_EVENT):
-                self.RecvEvents_q.put(line)
-            elif line.startswith(RESPONSE_OK_INIT):
-                self.Resp_q.put(line)
-                self.Info_q.put(line)
-            else:
-                self.Info_q.put(line)
-            continue
+        if self._read_thread is not None:
+            raise Rak811v2Error('pump() is only available in single threaded '
+                                'mode')
+        readable, _, _ = select([self._serial.fileno()], [], [], timeout)
+        if readable:
+            data = self._serial.read(self._serial.in_waiting or 1)
+            self._line_protocol.data_received(data)
+
+    def _pump_until(self, has_line, timeout):
+        """Pump until has_line() is True or timeout expires."""
+        deadline = monotonic() + timeout
+        while not has_line():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            self.pump(remaining)
+
+    def _pop(self, tag):
+        """Remove and return oldest line for tag; caller holds the lock."""
+        for i, (line_tag, line) in enumerate(self._buf):
+            if line_tag == tag:
+                del self._buf[i]
+                self._counts[tag] -= 1
+                return line
+
+    def _get(self, tag, timeout, message):
+        """Wait for a line with given tag.
+
+        Raise Rak811v2TimeoutError with message if none is received in time.
+        """
+        if self._read_thread is None:
+            self._pump_until(partial(self._has, tag), timeout)
+            timeout = 0
+
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._counts[tag], timeout):
+                raise Rak811v2TimeoutError(message)
+            return self._pop(tag)
 
+    def _has(self, tag):
+        """Poll for a line with given tag, without blocking."""
+        if self._read_thread is None:
+            self.pump()
+        return self._counts[tag] > 0
+
+    def _drain(self, tag, quiet=0):
+        """Remove and return all lines received for tag.
+
+        Lines are collected until none is received for quiet seconds.
+        """
+        wait = quiet if self._read_thread is not None else 0
+        lines = []
+        while True:
+            if self._read_thread is None:
+                self._pump_until(partial(self._has, tag), quiet)
+            with self._cv:
+                if not self._cv.wait_for(lambda: self._counts[tag], wait):
+                    return lines
+                lines.extend(line for line_tag, line in self._buf
+                             if line_tag == tag)
+                self._buf = deque(item for item in self._buf
+                                  if item[0] != tag)
+                self._counts[tag] = 0
 
     def get_response(self, timeout=None):
         """Get response from module.
@@ -163,14 +283,8 @@ class Rak811v2Serial(object):
         if timeout is None:
             timeout = self._response_timeout
 
-        try:
-            response = self.Resp_q.get(True, timeout)
-        except Empty:
-                     raise Rak811v2TimeoutError(
-                         'Timeout while waiting for response'
-                     )
-        
-        return response
+        return self._get(_RESPONSE_TAG, timeout,
+                         'Timeout while waiting for response')
 
     def get_info(self, timeout=None):
         """Get response from module.
@@ -181,14 +295,8 @@ class Rak811v2Serial(object):
         if timeout is None:
             timeout = self._response_timeout
 
-        try:
-            info = self.Info_q.get(True, timeout)
-        except Empty:
-                     raise Rak811v2TimeoutError(
-                         'Timeout while waiting for response'
-                     )
-        
-        return info
+        return self._get(_INFO_TAG, timeout,
+                         'Timeout while waiting for response')
 
     def get_event(self, timeout=None):
         """Get events from module.
@@ -199,22 +307,56 @@ class Rak811v2Serial(object):
         if timeout is None:
             timeout = self._event_timeout
 
-        try:
-            event = self.RecvEvents_q.get(True, timeout)
-        except Empty:
-            raise Rak811v2TimeoutError(
-                'Timeout while waiting for events'
-                )
+        return self._get(_EVENT_TAG, timeout,
+                         'Timeout while waiting for events')
+
+    def has_response(self):
+        """Poll for a response line, without blocking."""
+        return self._has(_RESPONSE_TAG)
+
+    def has_info(self):
+        """Poll for an information line, without blocking."""
+        return self._has(_INFO_TAG)
 
-        return event
+    def has_event(self):
+        """Poll for an event line, without blocking."""
+        return self._has(_EVENT_TAG)
+
+    def drain_info(self, quiet=0):
+        """Return information lines received from module.
+
+        Wait until no line is received for quiet seconds (by default only
+        return the lines already received).
+        """
+        return self._drain(_INFO_TAG, quiet)
+
+    def drain_events(self):
+        """Return event lines already received from module."""
+        return self._drain(_EVENT_TAG)
+
+    def send_bytes(self, data):
+        """Send already encoded data to the module."""
+        _logger.debug("Send: %s", data)
+        try:
+            self._serial.write(data)
+        except SerialTimeoutException:
+            raise Rak811v2TimeoutError('Timeout while writing to module')
 
     def send_string(self, string):
         """Send string to the module."""
-        self._logger.debug("Send: %s", string)
-        self._serial.write((bytes)(string, 'utf-8'))
+        self.send_bytes(string.encode('utf-8'))
 
-    def send_command(self, command, clearq=True):
-        """Send AT command to the module."""
+    def send_frame(self, frame, clearq=True):
+        """Send a complete AT command frame (with 'at+' and EOL) as bytes."""
         if clearq:
             self._clear_all_qs()
-        self.send_string('at+{0}\r\n'.format(command))
+        self.send_bytes(frame)
+
+    def send_command(self, command, clearq=True):
+        """Send AT command to the module.
+
+        The command can be passed as string or already encoded as bytes.
+        """
+        if not isinstance(command, bytes):
+            command = command.encode('utf-8')
+        self.send_frame(b'at+%b\r\n' % command, clearq)